@@ -0,0 +1,57 @@
+import logging
+import time
+
+import bson
+import fire
+import numpy as np
+
+from rag.utils.embedding_codec import STORAGE_FORMATS, EMBEDDING_FIELD, EMBEDDING_SCALE_FIELD, encode_embedding, \
+    decode_embeddings, cosine_rerank
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def synthetic_corpus(num_docs: int, dimensions: int, num_clusters: int, seed: int) -> np.ndarray:
+    """Clustered unit vectors, close to the distribution of text embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dimensions))
+    vectors = centers[rng.integers(num_clusters, size=num_docs)] + 0.5 * rng.normal(size=(num_docs, dimensions))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark(num_docs: int = 5000, dimensions: int = 1536, num_queries: int = 100, top_k: int = 10,
+              num_clusters: int = 50, seed: int = 42):
+    """
+    This method will compare the embedding storage formats on a synthetic corpus:
+    BSON size per document, time to load the documents into a matrix and recall@k against the float64 vectors.
+    """
+    corpus = synthetic_corpus(num_docs, dimensions, num_clusters, seed)
+    rng = np.random.default_rng(seed + 1)
+    queries = corpus[rng.integers(num_docs, size=num_queries)] + 0.1 * rng.normal(size=(num_queries, dimensions))
+    expected = [set(cosine_rerank(query, corpus, top_k)) for query in queries]
+
+    logger.info(f"Corpus: {num_docs} documents, {dimensions} dimensions, {num_queries} queries, recall@{top_k}")
+    for storage_format in STORAGE_FORMATS:
+        encoded = []
+        for i, vector in enumerate(corpus):
+            embedding, scale = encode_embedding(vector.tolist(), storage_format)
+            document = {"text": f"document {i}", EMBEDDING_FIELD: embedding, "rating": float(i % 10)}
+            if scale is not None:
+                document[EMBEDDING_SCALE_FIELD] = scale
+            encoded.append(bson.encode(document))
+
+        start = time.perf_counter()
+        documents = [bson.decode(data) for data in encoded]
+        matrix = decode_embeddings(documents, storage_format)
+        load_time = time.perf_counter() - start
+
+        recall = np.mean([len(expected[i] & set(cosine_rerank(query, matrix, top_k))) / top_k
+                          for i, query in enumerate(queries)])
+        size = sum(len(data) for data in encoded) / num_docs
+        logger.info(f"{storage_format:>8}: {size:9.0f} bytes/doc, load {load_time * 1000:8.1f} ms, "
+                    f"recall@{top_k} {recall:.4f}")
+
+
+if __name__ == '__main__':
+    fire.Fire(benchmark)
@@ -6,7 +6,8 @@ from langchain_openai import OpenAIEmbeddings
 from langchain.vectorstores import MongoDBAtlasVectorSearch
 
 from rag.config_loader import config
-from rag.utils.mongodb_helper import get_mongo_collection, create_vector_search_index
+from rag.utils.metadata_catalog import MetadataCatalog
+from rag.utils.mongodb_helper import get_mongo_collection, create_vector_search_index, insert_documents
 from rag.utils.prepare_test_data import get_input_data
 
 
@@ -21,6 +22,7 @@ def initialize_data():
     vector_index_name = config["vector_index_name"]
     dimensions = config["embedding_model_dimensions"]
     similarity = config["similarity"]
+    storage_format = config["embedding_storage"]
 
     docs = get_input_data()
 
@@ -46,10 +48,23 @@ def initialize_data():
             "rating": "number",
             "release_date": "token",
             "genre": "token"
-        }
+        },
+        storage_format=storage_format
     )
 
-    MongoDBAtlasVectorSearch.from_documents(docs, embeddings, collection=collection)
+    if storage_format == "array":
+        MongoDBAtlasVectorSearch.from_documents(docs, embeddings, collection=collection)
+    else:
+        insert_documents(collection, docs, embeddings, storage_format=storage_format)
+
+    # Refresh the cached metadata catalog with the ingested documents
+    catalog_path = config["metadata_catalog_path"]
+    catalog = MetadataCatalog.load(catalog_path)
+    if catalog is None:
+        catalog = MetadataCatalog.build(collection, sample_size=config["metadata_catalog_sample_size"])
+    else:
+        catalog.update(docs)
+    catalog.save(catalog_path)
 
     logger.info("Initialization completed successfully")
 
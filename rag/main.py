@@ -1,96 +1,129 @@
+import asyncio
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import fire
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 
 from rag.config_loader import config
-from rag.metadata_filter import MetadataFilter
-
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain.vectorstores import MongoDBAtlasVectorSearch
-
+from rag.pipeline import SmartFilteringRAG
+from rag.session import ConversationSession
+from rag.utils.deadline import DeadlineExceeded, Hedger
+from rag.utils.metadata_catalog import load_or_build_catalog
 from rag.utils.mongodb_helper import get_mongo_collection
 from rag.utils.prepare_test_data import get_docs_metadata
+from rag.utils.profiling import Profiler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TIMED_OUT_ANSWER = "Sorry, the answer could not be generated in time."
 
-def generate_response(queries):
-    openai_api_key = os.getenv("OPEN_AI_API_KEY")
-    openai_api_base = os.getenv("OPEN_API_BASE")
 
-    # default_headers is optional
-    default_headers = os.getenv("OPEN_API_DEFAULT_HEADERS")
-    default_headers = json.loads(default_headers) if default_headers else None
+def answer_or_timeout(answer, query: str) -> str:
+    """This method will answer a query, or return TIMED_OUT_ANSWER if it runs out of time"""
+    try:
+        return answer(query)
+    except DeadlineExceeded as ex:
+        logger.warning(f"Query timed out: {query}: {ex}")
+        return TIMED_OUT_ANSWER
 
-    llm = ChatOpenAI(model=config["model"], openai_api_key=openai_api_key, openai_api_base=openai_api_base,
-                     default_headers=default_headers)
-    embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key, openai_api_base=openai_api_base,
-                                      default_headers=default_headers)
 
-    system_prompt = """Use the following pieces of context to answer the user question in subsequent messages.
-    The context was retrieved from a knowledge database and you should use only the facts from the context to answer.
-    If you don't know the answer, just say that you don't know, don't try to make up an answer, use the context.
-    Don't address the context directly, but use it to answer the user question like it's your own knowledge.
-    Context: ```{context}```
-    """
-
-    qa_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system_prompt),
-            ("human", "{query}"),
-        ]
-    )
+async def aanswer_or_timeout(answer, query: str) -> str:
+    """Async version of answer_or_timeout"""
+    try:
+        return await answer(query)
+    except DeadlineExceeded as ex:
+        logger.warning(f"Query timed out: {query}: {ex}")
+        return TIMED_OUT_ANSWER
 
-    logger.info(f"Input list of queries: {queries}")
 
-    for query in queries:
-        logger.info(f"Query: {query}")
+def generate_response(queries, concurrency: int = 1, use_asyncio: bool = False, session: bool = False,
+                      profile: bool = False, profile_mode: str = "sampling", profile_dir: str = ".profile",
+                      profile_allocations: bool = False):
+    """
+    This method will answer a list of queries.
+    :param queries: List of user queries
+    :param concurrency: Number of queries answered in parallel threads
+    :param use_asyncio: Answer all the queries concurrently in an asyncio event loop
+    :param session: Answer the queries in order as the turns of a conversation
+    :param profile: Profile the CPU time and the allocations, see rag.utils.profiling
+    :param profile_mode: "sampling" for collapsed stacks, or "cprofile"
+    :param profile_dir: Directory of the profiling reports
+    :param profile_allocations: Trace the allocations while profiling, in a separate run from the CPU profile
+    """
+    if not profile:
+        return answer_queries(queries, concurrency=concurrency, use_asyncio=use_asyncio, session=session)
 
-        database_name = config["database_name"]
-        collection_name = config["collection_name"]
+    profiler = Profiler(output_dir=profile_dir, mode=profile_mode, trace_allocations=profile_allocations)
+    profiler.start()
+    try:
+        answer_queries(queries, concurrency=concurrency, use_asyncio=use_asyncio, session=session)
+    finally:
+        profiler.stop()
+        profiler.write_reports()
 
-        collection = get_mongo_collection(db_name=database_name, collection_name=collection_name)
 
-        document_content_description, metadata_field_info = get_docs_metadata()
+def answer_queries(queries, concurrency: int, use_asyncio: bool, session: bool):
+    openai_api_key = os.getenv("OPEN_AI_API_KEY")
+    openai_api_base = os.getenv("OPEN_API_BASE")
 
-        metadata_filter = MetadataFilter(collection=collection,
-                                         llm=llm,
-                                         metadata_field_info=metadata_field_info,
-                                         document_content_description=document_content_description)
+    # default_headers is optional
+    default_headers = os.getenv("OPEN_API_DEFAULT_HEADERS")
+    default_headers = json.loads(default_headers) if default_headers else None
 
-        pre_filter, new_query = metadata_filter.generate_metadata_filter(query)
+    llm = ChatOpenAI(model=config["model"], openai_api_key=openai_api_key, openai_api_base=openai_api_base,
+                     default_headers=default_headers, timeout=config["request_deadline_seconds"],
+                     max_retries=config["llm_max_retries"])
+    embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key, openai_api_base=openai_api_base,
+                                      default_headers=default_headers)
 
-        logger.info(f"Original Query: {query}")
-        logger.info(f"Generated pre-filter: {pre_filter}")
-        logger.info(f"Generated new query: {new_query}")
+    database_name = config["database_name"]
+    collection_name = config["collection_name"]
 
-        query = new_query
+    collection = get_mongo_collection(db_name=database_name, collection_name=collection_name)
 
-        vectorstore = MongoDBAtlasVectorSearch(collection, embeddings)
-        retriever = vectorstore.as_retriever(
-            search_kwargs={'pre_filter': pre_filter}
-        )
+    catalog = load_or_build_catalog(collection, path=config["metadata_catalog_path"],
+                                    sample_size=config["metadata_catalog_sample_size"])
+    document_content_description, metadata_field_info = get_docs_metadata(catalog)
 
-        def format_docs(docs):
-            return "\n\n".join([d.page_content for d in docs])
+    hedger = Hedger(percentile=config["hedge_percentile"]) if config["hedge_llm_calls"] else None
 
-        chain = (
-                {"context": retriever | format_docs, "query": RunnablePassthrough()}
-                | qa_prompt
-                | llm
-                | StrOutputParser()
-        )
+    rag = SmartFilteringRAG(collection=collection,
+                            llm=llm,
+                            embeddings=embeddings,
+                            metadata_field_info=metadata_field_info,
+                            document_content_description=document_content_description,
+                            request_timeout=config["request_deadline_seconds"],
+                            stage_budgets=config["stage_budget_seconds"],
+                            max_iterations=config["agent_max_iterations"],
+                            hedger=hedger)
 
-        result = chain.invoke(query)
+    logger.info(f"Input list of queries: {queries}")
 
+    if session:
+        conversation = ConversationSession(rag, catalog)
+        results = [answer_or_timeout(conversation.ask, query) for query in queries]
+        logger.info(f"Session turns: {conversation.full_turns} full, {conversation.follow_up_turns} follow-ups, "
+                    f"{conversation.local_turns} evaluated on cached candidates")
+    elif use_asyncio:
+        async def run():
+            return await asyncio.gather(*[aanswer_or_timeout(rag.agenerate_response, query) for query in queries])
+
+        results = asyncio.run(run())
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda query: answer_or_timeout(rag.generate_response, query), queries))
+
+    for result in results:
         logger.info(result)
 
+    logger.info(f"Coalesced requests per stage: {rag.coalesced_requests()}")
+    if hedger is not None:
+        logger.info(f"Hedged LLM calls: {hedger.hedged}/{hedger.requests}")
+
 
 def main():
     fire.Fire(generate_response)
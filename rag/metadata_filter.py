@@ -1,16 +1,22 @@
 import logging
-from typing import Dict, Tuple
+import math
+from typing import Dict, Optional, Tuple
 
-from langchain.agents import create_tool_calling_agent, AgentExecutor
+from langchain.agents import AgentExecutor
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+from langchain.agents.output_parsers.tools import ToolsAgentOutputParser
 from langchain.chains.query_constructor.base import AttributeInfo, _format_attribute_info, StructuredQueryOutputParser
 from langchain.chains.query_constructor.base import load_query_constructor_runnable
 from langchain_community.query_constructors.mongodb_atlas import MongoDBAtlasTranslator
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate, HumanMessagePromptTemplate, \
     SystemMessagePromptTemplate
+from langchain_core.runnables import RunnablePassthrough
 
 from rag.prompts import enforce_constraints, EXAMPLES_WITH_LIMIT, DEFAULT_EXAMPLES, SYSTEM_PROMPT_TEMPLATE, \
     DEFAULT_SCHEMA_PROMPT
 from rag.tools import MongoDBClient, QueryExecutorMongoDBTool
+from rag.utils.deadline import Deadline, DeadlineExceeded, Hedger, call_llm, llm_call_kwargs, run_with_timeout
+from rag.utils.profiling import profiled
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,12 +27,15 @@ class MetadataFilter:
     MetadataFilter is responsible for generating a MongoDB pre-filter query based on the user query.
     """
 
-    def __init__(self, collection, llm, metadata_field_info, document_content_description):
+    def __init__(self, collection, llm, metadata_field_info, document_content_description,
+                 max_iterations: int = 5, hedger: Optional[Hedger] = None):
         """
         Initialize the MetadataFilter with a pymongo collection
         :param llm
         :param metadata_field_info: Dict of attribute_info and content_description
         :param document_content_description: Description of data
+        :param max_iterations: Max number of steps of the time based filter agent
+        :param hedger: Optional hedger of the query constructor LLM calls
         """
         self.collection = collection
         self.llm = llm
@@ -34,12 +43,16 @@ class MetadataFilter:
         self.translator = MongoDBAtlasTranslator()
         self.metadata_field_info = metadata_field_info
         self.document_content_description = document_content_description
+        self.max_iterations = max_iterations
+        self.hedger = hedger
 
-    def create_query_constructor(self):
+    @profiled("MetadataFilter.create_query_constructor")
+    def create_query_constructor(self, timeout: float = math.inf):
         """
         This method will create query constructor for the collection.
         The query constructor is a chain with a prompt created using collection's metadata and content description.
         This query constructor will be used to generate pre-filter for a user's query.
+        :param timeout: Timeout of the LLM request in seconds
         """
         query_constructor_run_name = "query_constructor"
 
@@ -50,7 +63,7 @@ class MetadataFilter:
         enable_limit = False
 
         query_constructor = load_query_constructor_runnable(
-            llm=self.llm,
+            llm=self.llm.bind(**llm_call_kwargs(timeout)),
             document_contents=self.document_content_description,
             attribute_info=self.metadata_field_info,
             enable_limit=enable_limit,
@@ -65,27 +78,38 @@ class MetadataFilter:
 
         return query_constructor
 
-    def generate_metadata_filter(self, query: str) -> Dict:
+    @profiled("MetadataFilter.generate_metadata_filter")
+    def generate_metadata_filter(self, query: str, deadline: Optional[Deadline] = None) -> Dict:
         """
         This method will use the query constructor and generate the pre-filters for a list of datasets.
+        The time based filter is skipped if it runs out of its "time_filter" budget.
         :param query: User's query
+        :param deadline: Optional deadline of the filter generation
         :return (dict): Returns pre-filter and new query for each dataset.
+        :raises DeadlineExceeded: if the query constructor does not complete before the deadline
         """
+        deadline = deadline or Deadline(math.inf)
         query = f"""Answer the below question:\n
                 Question: {query}
                 """
-        query_constructor = self.create_query_constructor()
+        timeout = deadline.remaining()
+        query_constructor = self.create_query_constructor(timeout)
 
         structured_query = {}
         try:
-            structured_query = query_constructor.invoke(query)
+            structured_query = call_llm(query_constructor.invoke, timeout, self.hedger, query)
             logger.info(f"Structured query: {structured_query}")
             new_query, new_kwargs = self.translator.visit_structured_query(structured_query)
             pre_filter = enforce_constraints(new_kwargs)
             logger.info(f"Generated pre-filter query: {pre_filter}")
             logger.info(f"Generated new query: {query} -> {new_query}")
             if pre_filter:
-                time_based_pre_filter, new_query = self.generate_time_based_filter(pre_filter, new_query)
+                try:
+                    time_based_pre_filter, new_query = self.generate_time_based_filter(
+                        pre_filter, new_query, deadline.child("time_filter"))
+                except DeadlineExceeded as ex:
+                    logger.warning(f"Skipping time based filter: {ex}")
+                    time_based_pre_filter = None
                 if time_based_pre_filter:
                     logger.info(f"Merging metadata filter: {pre_filter}, and\n\t{time_based_pre_filter}")
                     pre_filter["pre_filter"] = {
@@ -98,15 +122,19 @@ class MetadataFilter:
             raise ex
         return pre_filter, new_query
 
-    def generate_time_based_filter(self, pre_filter: Dict, query: str) -> Tuple[str, Dict]:
+    @profiled("MetadataFilter.generate_time_based_filter")
+    def generate_time_based_filter(self, pre_filter: Dict, query: str,
+                                   deadline: Optional[Deadline] = None) -> Tuple[str, Dict]:
         """
         This method is responsible for generating filter query for "most recent", "latest", "earliest" type of user
         questions.
         :param pre_filter: (Dict) metadata pre-filter query
         :param query: (str) user query
-        :param dataset: (str) MongoDB collection name
+        :param deadline: (Deadline) optional deadline of the agent
         :return: (Tuple[str, Dict]) Rewritten user question and time-based filter query
+        :raises DeadlineExceeded: if the agent runs out of time or iterations
         """
+        deadline = deadline or Deadline(math.inf)
         client = MongoDBClient(collection=self.collection)
         executor_tool = QueryExecutorMongoDBTool(client=client, match_filter=pre_filter["pre_filter"])
         tools = [executor_tool]
@@ -123,9 +151,21 @@ class MetadataFilter:
                                                                   template="{input}")),
                                         MessagesPlaceholder(variable_name="agent_scratchpad")])
 
-        agent = create_tool_calling_agent(self.llm, tools, prompt)
-        agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
-        structured_query = agent_executor.invoke({"input": query})
+        max_execution_time = deadline.remaining()
+        # Same agent as create_tool_calling_agent, with each LLM request bounded by the agent's time budget
+        agent = (
+            RunnablePassthrough.assign(
+                agent_scratchpad=lambda x: format_to_tool_messages(x["intermediate_steps"])
+            )
+            | prompt
+            | self.llm.bind_tools(tools, **llm_call_kwargs(max_execution_time))
+            | ToolsAgentOutputParser()
+        )
+        agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True, max_iterations=self.max_iterations,
+                                       max_execution_time=None if math.isinf(max_execution_time) else max_execution_time)
+        structured_query = run_with_timeout(agent_executor.invoke, max_execution_time, {"input": query})
+        if structured_query["output"].startswith("Agent stopped due to"):
+            raise DeadlineExceeded(structured_query["output"])
         allowed_attributes = []
         for ainfo in self.metadata_field_info:
             allowed_attributes.append(
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import math
+from typing import Awaitable, Dict, List, Optional, Tuple
+
+from langchain.vectorstores import MongoDBAtlasVectorSearch
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from rag.metadata_filter import MetadataFilter
+from rag.utils.deadline import Deadline, DeadlineExceeded, Hedger, call_llm, llm_call_kwargs, run_with_timeout
+from rag.utils.embedding_codec import vector_projection
+from rag.utils.profiling import profiled
+from rag.utils.single_flight import SingleFlight, SingleFlightEmbeddings, normalize_query
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGES = ("filter", "embedding", "retrieval", "answer")
+# Number of documents used as context, the default of the langchain retriever
+DEFAULT_K = 4
+
+QA_SYSTEM_PROMPT = """Use the following pieces of context to answer the user question in subsequent messages.
+    The context was retrieved from a knowledge database and you should use only the facts from the context to answer.
+    If you don't know the answer, just say that you don't know, don't try to make up an answer, use the context.
+    Don't address the context directly, but use it to answer the user question like it's your own knowledge.
+    Context: ```{context}```
+    """
+
+
+def format_docs(docs: List[Document]) -> str:
+    return "\n\n".join([d.page_content for d in docs])
+
+
+async def _await_stage(awaitable: Awaitable, timeout: float):
+    try:
+        return await asyncio.wait_for(awaitable, timeout=None if math.isinf(timeout) else timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"Stage did not complete in {timeout:.2f}s")
+
+
+class SmartFilteringRAG:
+    """
+    SmartFilteringRAG answers a user query in stages: pre-filter generation, embedding, vector search with the
+    pre-filter and answer generation. Identical queries in flight at the same time share each stage's computation.
+    Each request has a deadline and each stage a time budget: when the filter generation runs out of time the
+    query is answered without pre-filter.
+    """
+
+    def __init__(self, collection, llm, embeddings, metadata_field_info, document_content_description,
+                 request_timeout: float = math.inf, stage_budgets: Optional[Dict[str, float]] = None,
+                 max_iterations: int = 5, hedger: Optional[Hedger] = None):
+        """
+        :param collection: pymongo collection object
+        :param llm: chat model used for the filters and the answer
+        :param embeddings: embeddings model
+        :param metadata_field_info: List of AttributeInfo of the filterable fields
+        :param document_content_description: Description of data
+        :param request_timeout: Default deadline of a request in seconds
+        :param stage_budgets: Dict of stage name (filter, time_filter, retrieval, answer) to its budget in seconds
+        :param max_iterations: Max number of steps of the time based filter agent
+        :param hedger: Optional hedger of the LLM calls
+        """
+        self.request_timeout = request_timeout
+        self.stage_budgets = stage_budgets or {}
+        self.hedger = hedger
+        self.flights = {stage: SingleFlight(stage) for stage in STAGES}
+        self.metadata_filter = MetadataFilter(collection=collection,
+                                              llm=llm,
+                                              metadata_field_info=metadata_field_info,
+                                              document_content_description=document_content_description,
+                                              max_iterations=max_iterations,
+                                              hedger=hedger)
+        self.vectorstore = MongoDBAtlasVectorSearch(collection,
+                                                    SingleFlightEmbeddings(embeddings, self.flights["embedding"]))
+        self.llm = llm
+        self.qa_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", QA_SYSTEM_PROMPT),
+                ("human", "{query}"),
+            ]
+        )
+
+    def _answer_chain(self, timeout: float):
+        return self.qa_prompt | self.llm.bind(**llm_call_kwargs(timeout)) | StrOutputParser()
+
+    def _retriever(self, pre_filter: Dict, k: int):
+        return self.vectorstore.as_retriever(
+            search_kwargs={'pre_filter': pre_filter,
+                           'k': k,
+                           'post_filter_pipeline': [{"$project": vector_projection()}]}
+        )
+
+    @staticmethod
+    def _retrieval_key(new_query: str, pre_filter: Dict, k: int) -> tuple:
+        return normalize_query(new_query), json.dumps(pre_filter, sort_keys=True, default=str), k
+
+    def new_deadline(self) -> Deadline:
+        """Returns the deadline of a new request"""
+        return Deadline(self.request_timeout, self.stage_budgets)
+
+    def generate_filter(self, query: str, deadline: Deadline) -> Tuple[Dict, str]:
+        """
+        This method will generate the pre-filter and the rewritten query, without pre-filter if it runs out of time.
+        :param query: User's query
+        :param deadline: Deadline of the request
+        :return: Returns the pre-filter and the rewritten query
+        """
+        filter_deadline = deadline.child("filter")
+        timeout = filter_deadline.remaining()
+        try:
+            # The filter generation bounds its own LLM calls with the filter deadline
+            pre_filter, new_query = self.flights["filter"].do(normalize_query(query), timeout,
+                                                              self.metadata_filter.generate_metadata_filter,
+                                                              query, filter_deadline)
+        except DeadlineExceeded as ex:
+            logger.warning(f"Falling back to the unfiltered query: {ex}")
+            pre_filter, new_query = {}, query
+        logger.info(f"Original Query: {query}")
+        logger.info(f"Generated pre-filter: {pre_filter}")
+        logger.info(f"Generated new query: {new_query}")
+        return pre_filter, new_query
+
+    def retrieve(self, new_query: str, pre_filter: Dict, deadline: Deadline, k: int = DEFAULT_K) -> List[Document]:
+        """
+        This method will run the vector search with the pre-filter.
+        :param new_query: Rewritten query
+        :param pre_filter: MongoDB pre-filter
+        :param deadline: Deadline of the request
+        :param k: Number of documents to retrieve
+        :return: Returns the documents, most similar first
+        """
+        budget = deadline.budget("retrieval")
+        return self.flights["retrieval"].do(self._retrieval_key(new_query, pre_filter, k), budget,
+                                            run_with_timeout, self._retriever(pre_filter, k).invoke, budget, new_query)
+
+    def answer(self, new_query: str, docs: List[Document], deadline: Deadline) -> str:
+        """
+        This method will answer the query using the documents as context.
+        :param new_query: Rewritten query
+        :param docs: Retrieved documents
+        :param deadline: Deadline of the request
+        :return: Returns the answer
+        """
+        context = format_docs(docs)
+        budget = deadline.budget("answer")
+        return self.flights["answer"].do((normalize_query(new_query), context), budget,
+                                         call_llm, self._answer_chain(budget).invoke, budget, self.hedger,
+                                         {"context": context, "query": new_query})
+
+    @profiled("SmartFilteringRAG.generate_response")
+    def generate_response(self, query: str, deadline: Optional[Deadline] = None) -> str:
+        """
+        This method will generate the pre-filter, retrieve the documents and answer the user's query.
+        :param query: User's query
+        :param deadline: Optional deadline of the request, see new_deadline
+        :return: Returns the answer
+        :raises DeadlineExceeded: if the retrieval or the answer runs out of time
+        """
+        deadline = deadline or self.new_deadline()
+        logger.info(f"Query: {query}")
+        pre_filter, new_query = self.generate_filter(query, deadline)
+        docs = self.retrieve(new_query, pre_filter, deadline)
+        return self.answer(new_query, docs, deadline)
+
+    @profiled("SmartFilteringRAG.agenerate_response")
+    async def agenerate_response(self, query: str, deadline: Optional[Deadline] = None) -> str:
+        """
+        Async version of generate_response, identical queries awaited concurrently share each stage.
+        :param query: User's query
+        :param deadline: Optional deadline of the request, see new_deadline
+        :return: Returns the answer
+        :raises DeadlineExceeded: if the retrieval or the answer runs out of time
+        """
+        deadline = deadline or self.new_deadline()
+        logger.info(f"Query: {query}")
+        filter_deadline = deadline.child("filter")
+        timeout = filter_deadline.remaining()
+        try:
+            pre_filter, new_query = await _await_stage(
+                self.flights["filter"].do_async(normalize_query(query), timeout, asyncio.to_thread,
+                                                self.metadata_filter.generate_metadata_filter, query, filter_deadline),
+                timeout)
+        except DeadlineExceeded as ex:
+            logger.warning(f"Falling back to the unfiltered query: {ex}")
+            pre_filter, new_query = {}, query
+        logger.info(f"Original Query: {query}")
+        logger.info(f"Generated pre-filter: {pre_filter}")
+        logger.info(f"Generated new query: {new_query}")
+
+        budget = deadline.budget("retrieval")
+        docs = await _await_stage(
+            self.flights["retrieval"].do_async(self._retrieval_key(new_query, pre_filter, DEFAULT_K), budget,
+                                               self._retriever(pre_filter, DEFAULT_K).ainvoke, new_query),
+            budget)
+        context = format_docs(docs)
+        budget = deadline.budget("answer")
+        return await _await_stage(
+            self.flights["answer"].do_async((normalize_query(new_query), context), budget, asyncio.to_thread,
+                                            call_llm, self._answer_chain(budget).invoke, budget, self.hedger,
+                                            {"context": context, "query": new_query}),
+            budget)
+
+    def coalesced_requests(self) -> Dict[str, int]:
+        """Returns the number of coalesced calls per stage"""
+        return {stage: flight.coalesced for stage, flight in self.flights.items()}
@@ -0,0 +1,192 @@
+import logging
+import re
+from typing import Dict, List, Optional
+
+from langchain_core.documents import Document
+
+from rag.pipeline import DEFAULT_K, SmartFilteringRAG
+from rag.utils.local_filter import and_filters, filter_fields, matches, remove_field_conditions
+from rag.utils.metadata_catalog import MetadataCatalog
+from rag.utils.profiling import profiled
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Follow-ups starting with these words replace the conditions on the mentioned fields instead of narrowing them
+REPLACE_CUES = ("what about", "how about", "instead")
+STOP_WORDS = {"a", "an", "and", "about", "any", "are", "as", "at", "but", "for", "from", "how", "i", "in", "instead",
+              "is", "it", "just", "me", "of", "on", "one", "ones", "only", "or", "please", "released", "show", "than", "that",
+              "the", "them", "then", "these", "those", "to", "what", "which", "with"}
+
+YEAR_PATTERN = re.compile(r"\b(after|before|since|in|from|until)\s+(\d{4})\b")
+NUMBER_PATTERN = re.compile(r"\b(above|over|more than|greater than|at least|below|under|less than|at most)\s+"
+                            r"(\d+(?:\.\d+)?)\b")
+YEAR_CONDITIONS = {
+    "after": lambda year: {"$gt": f"{year}-12-31"},
+    "since": lambda year: {"$gte": f"{year}-01-01"},
+    "from": lambda year: {"$gte": f"{year}-01-01"},
+    "before": lambda year: {"$lt": f"{year}-01-01"},
+    "until": lambda year: {"$lte": f"{year}-12-31"},
+    "in": lambda year: {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"},
+}
+NUMBER_OPERATORS = {"above": "$gt", "over": "$gt", "more than": "$gt", "greater than": "$gt", "at least": "$gte",
+                    "below": "$lt", "under": "$lt", "less than": "$lt", "at most": "$lte"}
+
+
+def _words(text: str) -> List[str]:
+    return [word.rstrip("s") for word in re.findall(r"[a-z]+", text.lower())]
+
+
+class SessionTurn:
+    """State kept from the previous turn of a session"""
+
+    def __init__(self, pre_filter: Dict, new_query: str, candidates: List[Document], exhaustive: bool):
+        """
+        :param pre_filter: MongoDB pre-filter of the turn
+        :param new_query: Rewritten query of the turn
+        :param candidates: Documents retrieved with the pre-filter, most similar first
+        :param exhaustive: True if the candidates hold every document matching the pre-filter
+        """
+        self.pre_filter = pre_filter
+        self.new_query = new_query
+        self.candidates = candidates
+        self.exhaustive = exhaustive
+
+
+class FollowUpPlan:
+    """Pre-filter of a follow-up query, derived from the previous turn without calling the LLM"""
+
+    def __init__(self, pre_filter: Dict, narrows: bool):
+        """
+        :param pre_filter: MongoDB pre-filter of the follow-up
+        :param narrows: True if the pre-filter only adds conditions to the previous one
+        """
+        self.pre_filter = pre_filter
+        self.narrows = narrows
+
+
+class ConversationSession:
+    """
+    ConversationSession answers the turns of a conversation. A follow-up query which only adds or changes filter
+    conditions, e.g. "only the ones after 2000" or "what about anime?", is applied as a delta to the previous
+    pre-filter and, when it narrows it, evaluated on the previously retrieved candidates. The LLM filter generation
+    and the vector search only run when the topic changes.
+    """
+
+    def __init__(self, rag: SmartFilteringRAG, catalog: MetadataCatalog, k: int = DEFAULT_K, candidate_k: int = 20):
+        """
+        :param rag: SmartFilteringRAG answering the queries
+        :param catalog: Metadata catalog, used to recognize the field values in the follow-ups
+        :param k: Number of documents used as context
+        :param candidate_k: Number of candidates retrieved and kept for the follow-ups
+        """
+        self.rag = rag
+        self.catalog = catalog
+        self.k = k
+        self.candidate_k = candidate_k
+        self.fields = {ainfo.name for ainfo in rag.metadata_filter.metadata_field_info}
+        self.previous_turn: Optional[SessionTurn] = None
+        self.full_turns = 0
+        self.follow_up_turns = 0
+        self.local_turns = 0
+
+    def _fields_of_type(self, *field_types: str) -> List[str]:
+        return sorted(name for name in self.fields if self.catalog.field_type(name) in field_types)
+
+    def plan_follow_up(self, query: str) -> Optional[FollowUpPlan]:
+        """
+        This method will derive the pre-filter of a follow-up query from the previous turn's pre-filter.
+        :param query: User's query
+        :return: Returns the plan or None if the query is not a follow-up of the previous turn
+        """
+        text = query.lower()
+        conditions = {}
+        explained = text
+
+        for field in self._fields_of_type("string", "[string]"):
+            values = [value for value in self.catalog.vocabulary(field)
+                      if re.search(rf"\b{re.escape(value.lower())}s?\b", text)]
+            if values:
+                conditions[field] = {"$in": values}
+                for value in values:
+                    explained = re.sub(rf"\b{re.escape(value.lower())}s?\b", " ", explained)
+
+        date_fields = self._fields_of_type("date")
+        for match in YEAR_PATTERN.finditer(text):
+            if len(date_fields) != 1:
+                return None
+            condition = YEAR_CONDITIONS[match.group(1)](match.group(2))
+            conditions.setdefault(date_fields[0], {}).update(condition)
+            explained = explained.replace(match.group(0), " ")
+
+        numeric_fields = self._fields_of_type("integer", "float")
+        for match in NUMBER_PATTERN.finditer(text):
+            # A field is mentioned by a word sharing its first letters, e.g. "rated" for "rating"
+            mentioned = [field for field in numeric_fields if re.search(rf"\b{re.escape(field.lower()[:3])}", text)]
+            fields = mentioned if mentioned else numeric_fields
+            if len(fields) != 1:
+                return None
+            conditions.setdefault(fields[0], {})[NUMBER_OPERATORS[match.group(1)]] = float(match.group(2))
+            explained = explained.replace(match.group(0), " ")
+            explained = re.sub(rf"\b{re.escape(fields[0].lower()[:3])}[a-z]*\b", " ", explained)
+
+        # Any other word which is not in the previous query means that the topic changed
+        known_words = STOP_WORDS | set(_words(self.previous_turn.new_query))
+        unexplained = [word for word in _words(explained) if word not in known_words]
+        if not conditions or unexplained:
+            logger.info(f"Not a follow-up: {query}, unexplained words: {unexplained}")
+            return None
+
+        pre_filter = self.previous_turn.pre_filter
+        replace = any(cue in text for cue in REPLACE_CUES)
+        narrows = True
+        for field, condition in conditions.items():
+            if replace and field in filter_fields(pre_filter):
+                pre_filter = remove_field_conditions(pre_filter, field)
+                narrows = False
+        pre_filter = and_filters([pre_filter] + [{field: condition} for field, condition in conditions.items()])
+        return FollowUpPlan(pre_filter=pre_filter, narrows=narrows)
+
+    @profiled("ConversationSession.ask")
+    def ask(self, query: str) -> str:
+        """
+        This method will answer a turn of the conversation.
+        :param query: User's query
+        :return: Returns the answer
+        """
+        deadline = self.rag.new_deadline()
+        logger.info(f"Session query: {query}")
+        plan = self.plan_follow_up(query) if self.previous_turn is not None else None
+
+        if plan is None:
+            self.full_turns += 1
+            pre_filter, new_query = self.rag.generate_filter(query, deadline)
+            candidates = None
+        else:
+            self.follow_up_turns += 1
+            pre_filter, new_query = plan.pre_filter, self.previous_turn.new_query
+            logger.info(f"Follow-up pre-filter: {pre_filter}")
+            candidates = None
+            if plan.narrows:
+                previous = self.previous_turn.candidates
+                local = [doc for doc in previous if matches(doc.metadata, pre_filter)]
+                # The previous candidates hold every match of a narrower filter ranked above the last candidate,
+                # so the top k are exact if k of them match or if they hold every match of the previous filter
+                if len(local) >= self.k or self.previous_turn.exhaustive:
+                    candidates = local
+                    exhaustive = self.previous_turn.exhaustive
+                    self.local_turns += 1
+                    logger.info(f"Follow-up evaluated on {len(previous)} cached candidates, {len(local)} matched")
+
+        if candidates is None:
+            candidates = self.rag.retrieve(new_query, pre_filter, deadline, k=self.candidate_k)
+            # A search returning less than candidate_k documents returned every match of its pre-filter
+            exhaustive = len(candidates) < self.candidate_k
+
+        self.previous_turn = SessionTurn(pre_filter=pre_filter, new_query=new_query, candidates=candidates,
+                                         exhaustive=exhaustive)
+        return self.rag.answer(new_query, candidates[:self.k], deadline)
+
+    def reset(self) -> None:
+        """Starts a new conversation"""
+        self.previous_turn = None
@@ -0,0 +1,142 @@
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fire
+import numpy as np
+from langchain_core.embeddings import FakeEmbeddings
+
+from rag.pipeline import SmartFilteringRAG
+from rag.utils.deadline import Deadline, Hedger, call_llm
+from rag.utils.fake_llm import FakeLatencyChatModel, default_response, tail_latency
+from rag.utils.prepare_test_data import get_docs_metadata
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Only report the summary of each run
+logging.getLogger().setLevel(logging.ERROR)
+logger.setLevel(logging.INFO)
+
+QUERY = "Recommend the latest anime movie"
+GENRE_FILTER = {"genre": {"$eq": "anime"}}
+TIME_FILTER_RESPONSE = """\
+```json
+{
+    "query": "movie",
+    "filter": "gt(\\"release_date\\", \\"2000-01-01\\")"
+}
+```\
+"""
+
+
+class FakeCollection:
+    """Collection returning a fixed vector search result"""
+
+    def aggregate(self, pipeline):
+        return [{"text": "A psychologist / detective gets lost in a series of dreams", "score": 0.9,
+                 "genre": ["anime"], "release_date": "2006-11-25"}]
+
+
+def time_filter_response(messages) -> str:
+    """Answers the time based filter agent with a release date filter, the other calls as default_response"""
+    if "date range query" in "\n".join(str(message.content) for message in messages):
+        return TIME_FILTER_RESPONSE
+    return default_response(messages)
+
+
+def slow_on(marker: str, seconds: float):
+    """Returns a response function answering the calls whose prompt contains marker after seconds"""
+    def respond(messages) -> str:
+        if marker in "\n".join(str(message.content) for message in messages):
+            time.sleep(seconds)
+        return time_filter_response(messages)
+    return respond
+
+
+def check_deadlines(metadata_field_info, slow: float = 1.0, budget: float = 0.2):
+    """
+    This method will check that the deadlines degrade the answers as documented:
+    - the time based filter is skipped when it runs out of its budget or of iterations
+    - the query is answered without pre-filter when the filter generation runs out of its budget
+    - a call slower than the latency percentile is hedged
+    """
+    def pipeline(respond, max_iterations=5):
+        return SmartFilteringRAG(collection=FakeCollection(), llm=FakeLatencyChatModel(respond=respond),
+                                 embeddings=FakeEmbeddings(size=8), metadata_field_info=metadata_field_info,
+                                 document_content_description="Brief summary of a movie",
+                                 stage_budgets={"filter": 3 * budget, "time_filter": budget},
+                                 max_iterations=max_iterations)
+
+    def generate_filter(rag):
+        start = time.perf_counter()
+        result = rag.generate_filter(QUERY, rag.new_deadline())
+        return result, time.perf_counter() - start
+
+    (pre_filter, _), _ = generate_filter(pipeline(time_filter_response))
+    assert pre_filter == {"$and": [GENRE_FILTER, {"release_date": {"$gt": "2000-01-01"}}]}, pre_filter
+
+    (pre_filter, _), elapsed = generate_filter(pipeline(slow_on("date range query", slow)))
+    assert pre_filter == GENRE_FILTER and elapsed < slow, (pre_filter, elapsed)
+    logger.info(f"Time based filter skipped after {elapsed * 1000:.0f} ms, out of budget")
+
+    (pre_filter, _), _ = generate_filter(pipeline(time_filter_response, max_iterations=0))
+    assert pre_filter == GENRE_FILTER, pre_filter
+    logger.info("Time based filter skipped, out of iterations")
+
+    (pre_filter, new_query), elapsed = generate_filter(pipeline(slow_on("<< Structured Request Schema >>", slow)))
+    assert (pre_filter, new_query) == ({}, QUERY) and elapsed < slow, (pre_filter, new_query, elapsed)
+    logger.info(f"Fell back to the unfiltered query after {elapsed * 1000:.0f} ms")
+
+    latencies = iter([0.01] * 5 + [slow])
+    llm = FakeLatencyChatModel(latency=lambda: next(latencies, 0.01))
+    hedger = Hedger(percentile=90, min_samples=5)
+    for _ in range(5):
+        call_llm(llm.invoke, slow, hedger, QUERY)
+    start = time.perf_counter()
+    call_llm(llm.invoke, 2 * slow, hedger, QUERY)
+    elapsed = time.perf_counter() - start
+    assert hedger.hedged == 1 and elapsed < slow, (hedger.hedged, elapsed)
+    logger.info(f"Slow call hedged, answered after {elapsed * 1000:.0f} ms")
+
+
+def run(name: str, rag: SmartFilteringRAG, num_requests: int, concurrency: int, deadline_seconds: float):
+    def request(i):
+        start = time.perf_counter()
+        # Distinct queries, so that the filter generation is not coalesced
+        rag.generate_response(f"Recommend an anime movie #{i}", Deadline(deadline_seconds, rag.stage_budgets))
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(request, range(num_requests))))
+    logger.info(f"{name:>28}: p50 {np.percentile(latencies, 50) * 1000:7.0f} ms, "
+                f"p99 {np.percentile(latencies, 99) * 1000:7.0f} ms, max {latencies.max() * 1000:7.0f} ms")
+
+
+def simulate(num_requests: int = 200, concurrency: int = 4, median: float = 0.05, slow: float = 2.0,
+             slow_rate: float = 0.03, filter_budget: float = 0.8, time_filter_budget: float = 0.3):
+    """
+    This method will check the deadline behaviours, then answer queries with a local fake LLM where slow_rate of
+    the calls take slow seconds, and compare the request latencies with and without deadlines and hedged LLM calls.
+    """
+    _, metadata_field_info = get_docs_metadata()
+    check_deadlines(metadata_field_info)
+
+    def pipeline(hedger=None, stage_budgets=None):
+        llm = FakeLatencyChatModel(latency=tail_latency(median, slow, slow_rate))
+        return SmartFilteringRAG(collection=FakeCollection(), llm=llm, embeddings=FakeEmbeddings(size=8),
+                                 metadata_field_info=metadata_field_info,
+                                 document_content_description="Brief summary of a movie",
+                                 stage_budgets=stage_budgets, hedger=hedger)
+
+    stage_budgets = {"filter": filter_budget, "time_filter": time_filter_budget}
+    run("no deadline", pipeline(), num_requests, concurrency, math.inf)
+    run("stage budgets", pipeline(stage_budgets=stage_budgets), num_requests, concurrency, math.inf)
+    hedger = Hedger(percentile=90, min_samples=20)
+    run("stage budgets, hedged calls", pipeline(hedger=hedger, stage_budgets=stage_budgets),
+        num_requests, concurrency, math.inf)
+    logger.info(f"Hedged LLM calls: {hedger.hedged}/{hedger.requests}")
+
+
+if __name__ == '__main__':
+    fire.Fire(simulate)
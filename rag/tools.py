@@ -7,6 +7,8 @@ from langchain_core.callbacks import CallbackManagerForToolRun
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.tools import BaseTool
 
+from rag.utils.embedding_codec import vector_projection
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -17,7 +19,9 @@ class MongoDBClient:
     def __init__(self, collection):
         self.collection = collection
 
-    def run_aggregate_pipeline(self, pipeline: List[Dict]) -> List[Dict]:
+    def run_aggregate_pipeline(self, pipeline: List[Dict], include_vectors: bool = False) -> List[Dict]:
+        if not include_vectors:
+            pipeline = pipeline + [{"$project": vector_projection()}]
         documents = list(self.collection.aggregate(pipeline))
         return documents
 
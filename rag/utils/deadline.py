@@ -0,0 +1,196 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+from openai import APITimeoutError
+
+from rag.utils.profiling import active_profiler
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The blocking leaf calls run with a timeout (LLM requests, agent, vector search) share a bounded pool, the stages
+# and the coalesced callers wait in the caller's thread. A call which does not return in time is abandoned, not
+# joined, it keeps its worker until the per-call timeout of the LLM client (see llm_call_kwargs) ends it.
+MAX_WORKERS = 64
+_worker = threading.local()
+
+
+def _mark_worker() -> None:
+    _worker.in_pool = True
+
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="deadline", initializer=_mark_worker)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a stage runs out of its time budget"""
+
+
+# Raised by the LLM clients when a request bound with llm_call_kwargs runs out of its timeout
+CLIENT_TIMEOUT_ERRORS = (TimeoutError, APITimeoutError)
+
+
+class Deadline:
+    """
+    End-to-end request deadline. Each stage gets the smaller of its own budget and the time left for the request.
+    """
+
+    def __init__(self, seconds: float, stage_budgets: Optional[Dict[str, float]] = None):
+        """
+        :param seconds: Time budget of the request
+        :param stage_budgets: Dict of stage name to its time budget in seconds
+        """
+        self.expires_at = time.monotonic() + seconds
+        self.stage_budgets = stage_budgets or {}
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def budget(self, stage: str) -> float:
+        """Returns the time budget of a stage, bounded by the time left for the request"""
+        return min(self.remaining(), self.stage_budgets.get(stage, math.inf))
+
+    def child(self, stage: str) -> "Deadline":
+        """Returns the deadline of a stage, to be propagated to its sub-stages"""
+        return Deadline(self.budget(stage), self.stage_budgets)
+
+
+def _wait_timeout(timeout: float) -> Optional[float]:
+    return None if math.isinf(timeout) else timeout
+
+
+def _start(fn: Callable, args: tuple, kwargs: dict) -> Future:
+    profiler = active_profiler()
+    if profiler is not None:
+        # The worker threads are profiled like the thread of the wrapped call which hands them the call
+        fn, args = profiler.call, (fn,) + args
+    if not getattr(_worker, "in_pool", False):
+        return _executor.submit(fn, *args, **kwargs)
+    # A worker waiting for another worker can starve the pool under load: a call made from a worker runs in it
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as ex:
+        future.set_exception(ex)
+    return future
+
+
+def _result(future: Future, fn: Callable, timeout: float) -> Any:
+    # The client timeout of a call races with the wait for it, both mean that the call ran out of its budget
+    try:
+        return future.result()
+    except DeadlineExceeded:
+        raise
+    except CLIENT_TIMEOUT_ERRORS as ex:
+        raise DeadlineExceeded(f"{getattr(fn, '__name__', fn)} did not complete in {timeout:.2f}s: {ex}") from ex
+
+
+def llm_call_kwargs(timeout: float) -> Dict[str, float]:
+    """
+    Returns the kwargs bounding a single LLM request by the time budget of its stage, to bind to the chat model,
+    so that a call abandoned at the deadline does not keep running up to the client's default timeout.
+    :param timeout: Time budget in seconds
+    """
+    return {} if math.isinf(timeout) else {"timeout": timeout}
+
+
+def run_with_timeout(fn: Callable, timeout: float, *args, **kwargs) -> Any:
+    """
+    This function will run fn and wait at most timeout seconds for its result.
+    :param fn: Function to run
+    :param timeout: Time budget in seconds
+    :return: Returns the result of fn
+    :raises DeadlineExceeded: if fn does not complete in time
+    """
+    if timeout <= 0:
+        raise DeadlineExceeded(f"No time left to run {getattr(fn, '__name__', fn)}")
+    future = _start(fn, args, kwargs)
+    done, _ = wait([future], timeout=_wait_timeout(timeout))
+    if not done:
+        raise DeadlineExceeded(f"{getattr(fn, '__name__', fn)} did not complete in {timeout:.2f}s")
+    return _result(future, fn, timeout)
+
+
+class Hedger:
+    """
+    Hedger fires a second identical call when the first one is slower than a percentile of the observed latencies,
+    and returns the result of the first call to complete.
+    """
+
+    def __init__(self, percentile: float = 95, min_samples: int = 20, window: int = 1000):
+        """
+        :param percentile: Latency percentile after which the hedged call is fired
+        :param min_samples: Number of observed latencies required before hedging
+        :param window: Number of recent latencies kept
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedged = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def delay(self) -> Optional[float]:
+        """Returns the latency after which a call is hedged, None until enough latencies are observed"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+    def call(self, fn: Callable, timeout: float, *args, **kwargs) -> Any:
+        """
+        This method will run fn, hedged with a second call if the first exceeds the latency percentile.
+        :param fn: Function to run
+        :param timeout: Time budget in seconds
+        :return: Returns the result of the first call to complete successfully
+        :raises DeadlineExceeded: if no call completes in time
+        """
+        if timeout <= 0:
+            raise DeadlineExceeded(f"No time left to run {getattr(fn, '__name__', fn)}")
+        start = time.monotonic()
+        with self._lock:
+            self.requests += 1
+        delay = self.delay()
+        pending = {_start(fn, args, kwargs)}
+        done, pending = wait(pending, timeout=_wait_timeout(min(delay, timeout) if delay is not None else timeout))
+        if not done and delay is not None and delay < timeout:
+            logger.info(f"Hedging {getattr(fn, '__name__', fn)} after {delay:.2f}s")
+            with self._lock:
+                self.hedged += 1
+            pending.add(_start(fn, args, kwargs))
+
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    with self._lock:
+                        self._latencies.append(time.monotonic() - start)
+                    return future.result()
+                error = future.exception()
+            remaining = timeout - (time.monotonic() - start)
+            if not pending or remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=_wait_timeout(remaining), return_when=FIRST_COMPLETED)
+
+        if error is not None and not pending and not isinstance(error, CLIENT_TIMEOUT_ERRORS):
+            raise error
+        with self._lock:
+            self._latencies.append(timeout)
+        raise DeadlineExceeded(f"{getattr(fn, '__name__', fn)} did not complete in {timeout:.2f}s")
+
+
+def call_llm(fn: Callable, timeout: float, hedger: Optional[Hedger], *args, **kwargs) -> Any:
+    """This function will run an LLM call within timeout, hedged if a hedger is given"""
+    if hedger is not None:
+        return hedger.call(fn, timeout, *args, **kwargs)
+    return run_with_timeout(fn, timeout, *args, **kwargs)
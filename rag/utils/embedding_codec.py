@@ -0,0 +1,79 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from bson.binary import Binary
+
+EMBEDDING_FIELD = "embedding"
+EMBEDDING_SCALE_FIELD = "embedding_scale"
+
+# "array" keeps the default langchain format: a BSON array of doubles
+STORAGE_FORMATS = ("array", "float16", "int8")
+# Formats Atlas Vector Search can index, the ones accepted by the embedding_storage setting.
+# float16 is only used to compare the formats in benchmark_embedding_storage.
+INDEXED_STORAGE_FORMATS = ("array", "int8")
+
+# BSON binary vector subtype, int8 vectors of this subtype can be indexed by Atlas Vector Search
+BINARY_VECTOR_SUBTYPE = 9
+INT8_DTYPE = b"\x03\x00"
+
+
+def vector_projection() -> Dict[str, int]:
+    """Returns the projection excluding the vector fields, to avoid pulling the vectors with every document"""
+    return {EMBEDDING_FIELD: 0, EMBEDDING_SCALE_FIELD: 0}
+
+
+def encode_embedding(vector: Sequence[float], storage_format: str) -> Tuple[object, Optional[float]]:
+    """
+    This function will pack an embedding in the given storage format.
+    :param vector: Embedding vector
+    :param storage_format: One of "array", "float16" or "int8"
+    :return: Returns the packed vector and its scale factor (None if the format is not scaled)
+    """
+    if storage_format == "array":
+        return list(vector), None
+    vector = np.asarray(vector, dtype=np.float32)
+    if storage_format == "float16":
+        return Binary(vector.astype("<f2").tobytes()), None
+    if storage_format == "int8":
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return Binary(INT8_DTYPE + quantized.tobytes(), BINARY_VECTOR_SUBTYPE), scale
+    raise ValueError(f"Unsupported embedding storage format: {storage_format}")
+
+
+def decode_embeddings(documents: List[Dict], storage_format: str) -> np.ndarray:
+    """
+    This function will decode the embeddings of a list of documents into a matrix, one row per document.
+    :param documents: MongoDB documents with the embedding (and scale) fields
+    :param storage_format: One of "array", "float16" or "int8"
+    :return: Returns a float32 matrix of shape (len(documents), dimensions)
+    """
+    if storage_format == "array":
+        return np.asarray([document[EMBEDDING_FIELD] for document in documents], dtype=np.float32)
+    payload = b"".join(bytes(document[EMBEDDING_FIELD]) for document in documents)
+    if storage_format == "float16":
+        return np.frombuffer(payload, dtype="<f2").reshape(len(documents), -1).astype(np.float32)
+    if storage_format == "int8":
+        matrix = np.frombuffer(payload, dtype=np.int8).reshape(len(documents), -1)
+        # Skip the dtype and padding bytes of every vector
+        matrix = matrix[:, len(INT8_DTYPE):].astype(np.float32)
+        scales = np.asarray([document[EMBEDDING_SCALE_FIELD] for document in documents], dtype=np.float32)
+        return matrix * scales[:, None]
+    raise ValueError(f"Unsupported embedding storage format: {storage_format}")
+
+
+def cosine_rerank(query_vector: Sequence[float], embeddings: np.ndarray, top_k: Optional[int] = None) -> List[int]:
+    """
+    This function will rank the decoded embeddings by cosine similarity with the query vector.
+    :param query_vector: Query embedding
+    :param embeddings: Matrix returned by decode_embeddings
+    :param top_k: Number of indexes to return, all if None
+    :return: Returns the row indexes, most similar first
+    """
+    if len(embeddings) == 0:
+        return []
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query_vector)
+    scores = embeddings @ query_vector / np.where(norms == 0, 1, norms)
+    order = np.argsort(-scores, kind="stable")
+    return order[:top_k].tolist()
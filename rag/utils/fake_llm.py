@@ -0,0 +1,74 @@
+import random
+import time
+from typing import Any, Callable, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+FILTER_RESPONSE = """\
+```json
+{
+    "query": "movie",
+    "filter": "eq(\\"genre\\", \\"anime\\")"
+}
+```\
+"""
+
+NO_FILTER_RESPONSE = """\
+```json
+{
+    "query": "movie",
+    "filter": "NO_FILTER"
+}
+```\
+"""
+
+
+def default_response(messages: List[BaseMessage]) -> str:
+    """Returns a valid answer for the query constructor, the time based filter agent and the answer chain"""
+    prompt = "\n".join(str(message.content) for message in messages)
+    if "date range query" in prompt:
+        return NO_FILTER_RESPONSE
+    if "<< Structured Request Schema >>" in prompt:
+        return FILTER_RESPONSE
+    return "Paprika is an anime movie."
+
+
+def tail_latency(median: float = 0.05, slow: float = 2.0, slow_rate: float = 0.05) -> Callable[[], float]:
+    """Returns a latency function where a fraction of the calls are slow, like a loaded LLM endpoint"""
+    return lambda: slow if random.random() < slow_rate else random.uniform(0.5 * median, 1.5 * median)
+
+
+class FakeLatencyChatModel(BaseChatModel):
+    """Local chat model with injectable latency and responses, to exercise deadlines and hedging without an API"""
+
+    latency: Callable[[], float] = lambda: 0.0
+    respond: Callable[[List[BaseMessage]], str] = default_response
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-latency-chat-model"
+
+    def _generate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        self.calls += 1
+        latency = self.latency()
+        # Like the OpenAI client, a call bound with a timeout gives up after it
+        timeout = kwargs.get("timeout")
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Request timed out after {timeout:.2f}s")
+        time.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.respond(messages)))])
+
+    def bind_tools(self, tools, **kwargs):
+        # The fake model never calls the tools
+        return self
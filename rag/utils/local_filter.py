@@ -0,0 +1,98 @@
+from typing import Dict, List, Set
+
+COMPARATORS = {
+    "$eq": lambda value, target: value == target,
+    "$ne": lambda value, target: value != target,
+    "$gt": lambda value, target: value > target,
+    "$gte": lambda value, target: value >= target,
+    "$lt": lambda value, target: value < target,
+    "$lte": lambda value, target: value <= target,
+    "$in": lambda value, target: value in target,
+    "$nin": lambda value, target: value not in target,
+}
+
+
+def _compare(value, operator: str, target) -> bool:
+    if operator not in COMPARATORS:
+        raise ValueError(f"Unsupported operator: {operator}")
+    if value is None:
+        return operator in ("$ne", "$nin")
+    # Like MongoDB, a condition on an array field matches if any of its elements matches
+    values = value if isinstance(value, list) else [value]
+    if operator in ("$ne", "$nin"):
+        return all(COMPARATORS[operator](item, target) for item in values)
+    try:
+        return any(COMPARATORS[operator](item, target) for item in values)
+    except TypeError:
+        return False
+
+
+def matches(document: Dict, pre_filter: Dict) -> bool:
+    """
+    This function will evaluate a MongoDB pre-filter on a document locally.
+    Supports $and, $or and the comparators generated by MongoDBAtlasTranslator.
+    :param document: Document or metadata dict
+    :param pre_filter: MongoDB filter
+    :return: Returns True if the document matches the filter
+    """
+    for key, condition in pre_filter.items():
+        if key == "$and":
+            if not all(matches(document, item) for item in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, item) for item in condition):
+                return False
+        elif isinstance(condition, dict):
+            if not all(_compare(document.get(key), operator, target) for operator, target in condition.items()):
+                return False
+        elif not _compare(document.get(key), "$eq", condition):
+            return False
+    return True
+
+
+def filter_fields(pre_filter: Dict) -> Set[str]:
+    """Returns the names of the fields used in a MongoDB filter"""
+    fields = set()
+    for key, condition in pre_filter.items():
+        if key in ("$and", "$or"):
+            for item in condition:
+                fields |= filter_fields(item)
+        else:
+            fields.add(key)
+    return fields
+
+
+def _conjuncts(pre_filter: Dict) -> List[Dict]:
+    """Returns the conditions of a MongoDB filter which must all match, flattening the nested $and"""
+    conjuncts = []
+    for key, condition in pre_filter.items():
+        if key == "$and":
+            for item in condition:
+                conjuncts.extend(_conjuncts(item))
+        else:
+            conjuncts.append({key: condition})
+    return conjuncts
+
+
+def remove_field_conditions(pre_filter: Dict, field: str) -> Dict:
+    """
+    This function will remove the conditions on a field from a MongoDB filter.
+    Conditions are removed from the $and at any depth: an $or using the field is removed as a whole.
+    :param pre_filter: MongoDB filter
+    :param field: Field name
+    :return: Returns the filter without the conditions on the field
+    """
+    return and_filters([item for item in _conjuncts(pre_filter) if field not in filter_fields(item)])
+
+
+def and_filters(conditions: List[Dict]) -> Dict:
+    """Returns the conjunction of MongoDB filters, flattening nested $and and dropping empty filters"""
+    flattened = []
+    for condition in conditions:
+        if list(condition) == ["$and"]:
+            flattened.extend(condition["$and"])
+        elif condition:
+            flattened.append(condition)
+    if not flattened:
+        return {}
+    return flattened[0] if len(flattened) == 1 else {"$and": flattened}
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import random
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from langchain_core.documents import Document
+from pymongo.collection import Collection
+
+from rag.utils.embedding_codec import EMBEDDING_FIELD, EMBEDDING_SCALE_FIELD
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Fields written by MongoDBAtlasVectorSearch that are not metadata
+DEFAULT_EXCLUDED_FIELDS = ("_id", "text", EMBEDDING_FIELD, EMBEDDING_SCALE_FIELD)
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _value_kind(value) -> Optional[str]:
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, datetime):
+        return "date"
+    if isinstance(value, str):
+        return "date" if DATE_PATTERN.match(value) else "string"
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return "[string]"
+    return None
+
+
+def _resolve_type(kinds: Iterable[str]) -> str:
+    kinds = set(kinds)
+    if kinds <= {"integer"}:
+        return "integer"
+    if kinds <= {"integer", "float"}:
+        return "float"
+    if kinds <= {"date"}:
+        return "date"
+    if kinds <= {"date", "string"}:
+        return "string"
+    if kinds <= {"[string]", "date", "string"}:
+        return "[string]"
+    return "string"
+
+
+def _sort_key(value):
+    return isinstance(value, str), value
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(data: Dict):
+    return datetime.fromisoformat(data["$date"]) if list(data) == ["$date"] else data
+
+
+def _quantile(values: List, q: float):
+    index = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class MetadataCatalog:
+    """
+    Statistics about the metadata fields of a collection: inferred types, distinct values with frequencies for
+    token fields, and min/max/quantiles for numeric and date fields.
+    """
+
+    def __init__(self, fields: Optional[Dict] = None, document_count: int = 0, max_samples: int = 1000):
+        """
+        :param fields: Dict of field name to field statistics
+        :param document_count: Number of documents the statistics were computed on
+        :param max_samples: Size of the reservoir of values kept per numeric/date field for quantiles
+        """
+        self.fields = fields or {}
+        self.document_count = document_count
+        self.max_samples = max_samples
+
+    @classmethod
+    def build(cls, collection: Collection, sample_size: int = 1000,
+              excluded_fields: Iterable[str] = DEFAULT_EXCLUDED_FIELDS) -> "MetadataCatalog":
+        """
+        This method will sample the collection with an aggregation pipeline and compute the field statistics.
+        :param collection: pymongo collection object
+        :param sample_size: Number of documents to sample
+        :param excluded_fields: Fields which are not metadata, e.g. text and embedding
+        :return: Returns the metadata catalog
+        """
+        pipeline = [{"$sample": {"size": sample_size}},
+                    {"$project": {field: 0 for field in excluded_fields}}]
+        documents = list(collection.aggregate(pipeline))
+        logger.info(f"Building metadata catalog from {len(documents)} sampled documents")
+        catalog = cls(max_samples=sample_size)
+        catalog.update(documents, excluded_fields=excluded_fields)
+        if documents:
+            # Each sampled document stands for total / sampled documents of the collection
+            catalog._scale(collection.estimated_document_count() / len(documents))
+        return catalog
+
+    def _scale(self, factor: float) -> None:
+        self.document_count = round(self.document_count * factor)
+        for stats in self.fields.values():
+            stats["count"] = round(stats["count"] * factor)
+            stats["seen"] = round(stats["seen"] * factor)
+            stats["values"] = {value: round(count * factor) for value, count in stats["values"].items()}
+
+    def update(self, documents: Iterable, excluded_fields: Iterable[str] = DEFAULT_EXCLUDED_FIELDS) -> None:
+        """
+        This method will incrementally add the statistics of newly ingested documents to the catalog.
+        The values of numeric/date fields are kept in a reservoir sample, so that every value observed since the
+        catalog was built has the same chance to be in it, whatever the number of updates.
+        :param documents: List of langchain Documents or MongoDB documents
+        :param excluded_fields: Fields which are not metadata
+        """
+        excluded_fields = set(excluded_fields)
+        for document in documents:
+            metadata = document.metadata if isinstance(document, Document) else document
+            self.document_count += 1
+            for name, value in metadata.items():
+                kind = _value_kind(value)
+                if name in excluded_fields or kind is None:
+                    continue
+                stats = self.fields.setdefault(name, {"kinds": [], "count": 0, "values": {}, "samples": [],
+                                                      "seen": 0, "min": None, "max": None})
+                stats["count"] += 1
+                if kind not in stats["kinds"]:
+                    stats["kinds"].append(kind)
+                if kind in ("string", "[string]"):
+                    for token in value if isinstance(value, list) else [value]:
+                        stats["values"][token] = stats["values"].get(token, 0) + 1
+                else:
+                    self._add_sample(stats, value)
+
+    def _add_sample(self, stats: Dict, value) -> None:
+        if stats["min"] is None or _sort_key(value) < _sort_key(stats["min"]):
+            stats["min"] = value
+        if stats["max"] is None or _sort_key(value) > _sort_key(stats["max"]):
+            stats["max"] = value
+        stats["seen"] += 1
+        if len(stats["samples"]) < self.max_samples:
+            stats["samples"].append(value)
+        else:
+            index = random.randrange(stats["seen"])
+            if index < self.max_samples:
+                stats["samples"][index] = value
+
+    @staticmethod
+    def field_type_of(stats: Dict) -> str:
+        return _resolve_type(stats["kinds"])
+
+    def field_type(self, name: str) -> Optional[str]:
+        """Returns the inferred type of a field or None if the field is not catalogued"""
+        stats = self.fields.get(name)
+        return self.field_type_of(stats) if stats else None
+
+    def vocabulary(self, name: str, top_k: Optional[int] = None) -> List[str]:
+        """
+        Returns the distinct values of a token field, most frequent first.
+        :param name: Field name
+        :param top_k: Max number of values to return
+        """
+        stats = self.fields.get(name)
+        if not stats:
+            return []
+        values = sorted(stats["values"].items(), key=lambda item: (-item[1], item[0]))
+        return [value for value, _ in values[:top_k]]
+
+    def value_range(self, name: str, quantiles: Iterable[float] = (0.25, 0.5, 0.75)) -> Optional[Dict]:
+        """
+        Returns min, max and quantiles of a numeric or date field.
+        :param name: Field name
+        :param quantiles: Quantiles to compute
+        :return: Dict like {"min": .., "max": .., "quantiles": {0.5: ..}} or None
+        """
+        stats = self.fields.get(name)
+        if not stats or not stats["samples"]:
+            return None
+        values = sorted(stats["samples"], key=_sort_key)
+        return {
+            "min": stats["min"],
+            "max": stats["max"],
+            "quantiles": {q: _quantile(values, q) for q in quantiles}
+        }
+
+    def describe(self, name: str, description: str = "", top_k: int = 20) -> str:
+        """
+        This method will extend a field description with the values observed in the collection.
+        :param name: Field name
+        :param description: Base description of the field
+        :param top_k: Max number of keywords listed for token fields
+        :return: Returns the field description for the AttributeInfo
+        """
+        field_type = self.field_type(name)
+        if field_type in ("string", "[string]"):
+            return f"{description}. Keywords for filtering: {self.vocabulary(name, top_k)}".lstrip(". ")
+
+        value_range = self.value_range(name)
+        if value_range is None:
+            return description
+        quantiles = ", ".join(str(value) for value in value_range["quantiles"].values())
+        return (f"{description}. Values range from {value_range['min']} to {value_range['max']} "
+                f"(quartiles: {quantiles})").lstrip(". ")
+
+    def to_dict(self) -> Dict:
+        return {"document_count": self.document_count, "max_samples": self.max_samples, "fields": self.fields}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MetadataCatalog":
+        return cls(fields=data["fields"], document_count=data["document_count"], max_samples=data["max_samples"])
+
+    def save(self, path: str) -> None:
+        """This method will cache the catalog on disk"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, default=_encode)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["MetadataCatalog"]:
+        """This method will load the cached catalog, returns None if there is no cache"""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as file:
+            return cls.from_dict(json.load(file, object_hook=_decode))
+
+
+def load_or_build_catalog(collection: Collection, path: str, sample_size: int = 1000) -> MetadataCatalog:
+    """
+    This function will load the cached metadata catalog or build it from the collection if not cached.
+    :param collection: pymongo collection object
+    :param path: Path of the catalog cache
+    :param sample_size: Number of documents to sample while building the catalog
+    :return: Returns the metadata catalog
+    """
+    catalog = MetadataCatalog.load(path)
+    if catalog is None:
+        catalog = MetadataCatalog.build(collection, sample_size=sample_size)
+        catalog.save(path)
+    return catalog
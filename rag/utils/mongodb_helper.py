@@ -1,9 +1,13 @@
 import os
 from typing import List, Dict
 
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from pymongo import MongoClient
 from pymongo.collection import Collection
 
+from rag.utils.embedding_codec import EMBEDDING_FIELD, EMBEDDING_SCALE_FIELD, INDEXED_STORAGE_FORMATS, encode_embedding
+
 MONGO_URI = os.environ["MONGO_URI"]
 
 
@@ -27,7 +31,8 @@ def get_mongo_collection(db_name: str, collection_name: str,
 
 
 def create_vector_search_index(collection: Collection, index_name: str, embedded_field_names: List[str],
-                               dimensions: int, similarity: str, filter_fields_with_datatype: Dict[str, str]) -> None:
+                               dimensions: int, similarity: str, filter_fields_with_datatype: Dict[str, str],
+                               storage_format: str = "array") -> None:
     """
     This function will create vector search index on a mongo db collection
     :param collection: pymongo collection object
@@ -37,8 +42,26 @@ def create_vector_search_index(collection: Collection, index_name: str, embedded
     :param similarity: similarity type cosine/sine
     :param filter_fields_with_datatype: additional fields can be used for pre-filtering with vector search
                                         e.g: {"field_name": "field_datatype"}
+    :param storage_format: storage format of the embeddings, "array" or "int8". default to "array"
     :return:
     """
+    if storage_format not in INDEXED_STORAGE_FORMATS:
+        raise ValueError(f"Atlas Vector Search cannot index embeddings stored as {storage_format}")
+    if storage_format == "int8" and similarity != "cosine":
+        # Atlas scores the quantized vectors without their per-vector scale, which only cosine is invariant to
+        raise ValueError(f"int8 embedding storage requires cosine similarity, got {similarity}")
+    if storage_format == "int8":
+        # Binary int8 vectors are indexed by a vectorSearch index, with the same filter fields
+        fields = [{"type": "vector", "path": field, "numDimensions": dimensions, "similarity": similarity}
+                  for field in embedded_field_names]
+        fields += [{"type": "filter", "path": field_name} for field_name in filter_fields_with_datatype]
+        collection.create_search_index(
+            model={"name": index_name,
+                   "type": "vectorSearch",
+                   "definition": {"fields": fields}}
+        )
+        return
+
     fields = {}
     for field in embedded_field_names:
         fields[field] = {
@@ -65,3 +88,26 @@ def create_vector_search_index(collection: Collection, index_name: str, embedded
         model={"name": index_name,
                "definition": vector_index_definition}
     )
+
+
+def insert_documents(collection: Collection, docs: List[Document], embeddings: Embeddings,
+                     storage_format: str = "array") -> None:
+    """
+    This function will embed the documents and insert them with the embeddings packed in the given storage format.
+    The documents have the same layout as the ones inserted by MongoDBAtlasVectorSearch.from_documents.
+    :param collection: pymongo collection object
+    :param docs: list of langchain documents
+    :param embeddings: embeddings model
+    :param storage_format: storage format of the embeddings, see embedding_codec. default to "array"
+    :return:
+    """
+    vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+    records = []
+    for doc, vector in zip(docs, vectors):
+        embedding, scale = encode_embedding(vector, storage_format)
+        record = {"text": doc.page_content, EMBEDDING_FIELD: embedding, **doc.metadata}
+        if scale is not None:
+            record[EMBEDDING_SCALE_FIELD] = scale
+        records.append(record)
+    if records:
+        collection.insert_many(records)
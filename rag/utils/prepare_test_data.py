@@ -1,6 +1,10 @@
+from typing import Optional
+
 from langchain_core.documents import Document
 from langchain.chains.query_constructor.base import AttributeInfo
 
+from rag.utils.metadata_catalog import MetadataCatalog
+
 
 def get_input_data():
     docs = [
@@ -32,7 +36,11 @@ def get_input_data():
     return docs
 
 
-def get_docs_metadata():
+def get_docs_metadata(catalog: Optional[MetadataCatalog] = None):
+    """
+    Returns the content description and the filterable metadata fields.
+    :param catalog: Optional metadata catalog, used to describe the fields with the values in the collection
+    """
     metadata_field_info = [
         AttributeInfo(
             name="genre",
@@ -50,4 +58,15 @@ def get_docs_metadata():
     ]
     document_content_description = "Brief summary of a movie"
 
+    if catalog is not None:
+        # The hand-written keywords of genre and the types are replaced by the ones inferred from the collection
+        metadata_field_info = [
+            AttributeInfo(
+                name=ainfo.name,
+                description=catalog.describe(ainfo.name, "" if ainfo.name == "genre" else ainfo.description),
+                type=catalog.field_type(ainfo.name) or ainfo.type,
+            )
+            for ainfo in metadata_field_info
+        ]
+
     return document_content_description, metadata_field_info
\ No newline at end of file
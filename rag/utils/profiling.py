@@ -0,0 +1,265 @@
+import cProfile
+import functools
+import inspect
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("sampling", "cprofile")
+# Since Python 3.12 cProfile is built on sys.monitoring: a profile covers all the threads and only one can be enabled
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+
+_active_profiler: Optional["Profiler"] = None
+
+
+def _thread_cpu_ticks(native_id: int) -> Optional[int]:
+    """Returns the user + system CPU clock ticks of a thread, None if not available (Linux only)"""
+    try:
+        with open(f"/proc/self/task/{native_id}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        return int(fields[11]) + int(fields[12])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    """
+    Profiler collects where the CPU time and the allocations go while it is active:
+    - "sampling" mode samples the stacks of all the threads, written as collapsed stacks for flamegraphs.
+      Each stack is weighted by the CPU ticks of its thread since the previous sample, so that threads waiting
+      on I/O or on the LLM are not counted. Where the thread CPU times are not available, by wall-clock samples.
+    - "cprofile" mode runs the calls wrapped with @profiled under cProfile, written as pstats.
+      On Python 3.12+ a single cProfile covers the whole process instead, timed by the process CPU time.
+    Both modes rank the hottest functions in a summary, with the top allocation sites if allocations are traced.
+    Tracing the allocations slows down the whole process, trace them in a separate run from the CPU profile.
+    """
+
+    def __init__(self, output_dir: str = ".profile", mode: str = "sampling", interval: float = 0.005,
+                 top_n: int = 25, trace_allocations: bool = False, tracemalloc_frames: int = 10):
+        """
+        :param output_dir: Directory of the reports
+        :param mode: "sampling" or "cprofile"
+        :param interval: Sampling interval in seconds
+        :param top_n: Number of functions and allocation sites in the summary
+        :param trace_allocations: Take tracemalloc snapshots
+        :param tracemalloc_frames: Number of frames stored per allocation
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unsupported profile mode: {mode}")
+        self.output_dir = output_dir
+        self.mode = mode
+        self.interval = interval
+        self.top_n = top_n
+        self.trace_allocations = trace_allocations
+        self.tracemalloc_frames = tracemalloc_frames
+        self.stacks = Counter()
+        self.timings: Dict[str, list] = defaultdict(lambda: [0, 0.0])
+        self.stats: Optional[pstats.Stats] = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._start_snapshot = None
+        self._end_snapshot = None
+
+    def start(self) -> None:
+        global _active_profiler
+        _active_profiler = self
+        if self.trace_allocations:
+            tracemalloc.start(self.tracemalloc_frames)
+            self._start_snapshot = tracemalloc.take_snapshot()
+        if self.mode == "sampling":
+            self._stopped.clear()
+            self._sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+            self._sampler.start()
+        elif PROCESS_WIDE_CPROFILE:
+            self._profile = cProfile.Profile(time.process_time)
+            self._profile.enable()
+        logger.info(f"Profiling started in {self.mode} mode")
+
+    def stop(self) -> None:
+        global _active_profiler
+        _active_profiler = None
+        if self._sampler is not None:
+            self._stopped.set()
+            self._sampler.join()
+            self._sampler = None
+        if self._profile is not None:
+            self._profile.disable()
+            self.stats = pstats.Stats(self._profile)
+            self._profile = None
+        if not self.trace_allocations:
+            return
+        self._end_snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        # Ignore the allocations of the profiler itself
+        filters = [tracemalloc.Filter(False, module.__file__) for module in (sys.modules[__name__], cProfile, pstats)]
+        self._start_snapshot = self._start_snapshot.filter_traces(filters)
+        self._end_snapshot = self._end_snapshot.filter_traces(filters)
+
+    def _sample(self) -> None:
+        sampler_id = threading.get_ident()
+        cpu_ticks = {}
+        while not self._stopped.wait(self.interval):
+            native_ids = {thread.ident: thread.native_id for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                weight = 1
+                ticks = _thread_cpu_ticks(native_ids[thread_id]) if thread_id in native_ids else None
+                if ticks is not None:
+                    weight = ticks - cpu_ticks.get(thread_id, ticks)
+                    cpu_ticks[thread_id] = ticks
+                if weight <= 0:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += weight
+
+    def run(self, name: str, fn: Callable, *args, **kwargs):
+        """This method will run fn, timed under name and under cProfile in "cprofile" mode"""
+        start = time.perf_counter()
+        try:
+            return self.call(fn, *args, **kwargs)
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """
+        This method will run fn under cProfile in "cprofile" mode, without timing it.
+        Used for the calls handed over to worker threads by the wrapped calls, see rag.utils.deadline.
+        """
+        # cProfile is per thread and can not be nested, only the outermost call of a thread is profiled
+        if self.mode != "cprofile" or PROCESS_WIDE_CPROFILE or getattr(self._local, "profiling", False):
+            return fn(*args, **kwargs)
+        # Per thread CPU time, so that the time waiting for the LLM or MongoDB is not counted
+        profile = cProfile.Profile(time.thread_time)
+        self._local.profiling = True
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._local.profiling = False
+            with self._stats_lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def _record(self, name: str, elapsed: float) -> None:
+        with self._lock:
+            self.timings[name][0] += 1
+            self.timings[name][1] += elapsed
+
+    def hottest_functions(self) -> list:
+        """Returns (function, self samples, total samples) of the sampled stacks, by self samples"""
+        self_samples = Counter()
+        total_samples = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_samples[frames[-1]] += count
+            for frame in set(frames):
+                total_samples[frame] += count
+        return [(frame, count, total_samples[frame]) for frame, count in self_samples.most_common(self.top_n)]
+
+    def summary(self) -> str:
+        """Returns the wrapped call timings, the hottest functions and the top allocation sites"""
+        lines = ["Wrapped calls (calls, total seconds):"]
+        for name, (calls, elapsed) in sorted(self.timings.items(), key=lambda item: -item[1][1]):
+            lines.append(f"  {name}: {calls}, {elapsed:.3f}s")
+
+        if self.mode == "sampling":
+            total = sum(self.stacks.values()) or 1
+            lines.append(f"Hottest functions ({total} samples, self % / total %):")
+            for frame, self_count, total_count in self.hottest_functions():
+                lines.append(f"  {100 * self_count / total:5.1f}% {100 * total_count / total:5.1f}%  {frame}")
+        elif self.stats is not None:
+            stream = io.StringIO()
+            self.stats.stream = stream
+            self.stats.sort_stats("tottime").print_stats(self.top_n)
+            lines.append("Hottest functions (cProfile, by own time):")
+            lines.append(stream.getvalue())
+
+        if self._end_snapshot is not None:
+            lines.append("Top allocation sites since the start of profiling:")
+            for stat in self._end_snapshot.compare_to(self._start_snapshot, "lineno")[:self.top_n]:
+                lines.append(f"  {stat}")
+        return "\n".join(lines)
+
+    def write_reports(self) -> None:
+        """
+        This method will write the reports in the output directory:
+        stacks.collapsed (sampling mode), profile.pstats (cprofile mode), allocations.txt and summary.txt
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.mode == "sampling":
+            with open(os.path.join(self.output_dir, "stacks.collapsed"), 'w') as file:
+                for stack, count in self.stacks.items():
+                    file.write(f"{stack} {count}\n")
+        elif self.stats is not None:
+            self.stats.dump_stats(os.path.join(self.output_dir, "profile.pstats"))
+
+        if self._end_snapshot is not None:
+            with open(os.path.join(self.output_dir, "allocations.txt"), 'w') as file:
+                for stat in self._end_snapshot.statistics("traceback")[:self.top_n]:
+                    file.write(f"{stat}\n")
+                    file.write("\n".join(f"    {line}" for line in stat.traceback.format()) + "\n")
+
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, "summary.txt"), 'w') as file:
+            file.write(summary)
+        logger.info(f"Profiling reports written to {self.output_dir}\n{summary}")
+
+
+def active_profiler() -> Optional[Profiler]:
+    """Returns the started Profiler, if any"""
+    return _active_profiler
+
+
+def profiled(name: str):
+    """
+    Decorator running the function under the active Profiler, if any.
+    :param name: Name of the wrapped call in the summary
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                profiler = _active_profiler
+                if profiler is None:
+                    return await fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    profiler._record(name, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = _active_profiler
+            if profiler is None:
+                return fn(*args, **kwargs)
+            return profiler.run(name, fn, *args, **kwargs)
+        return wrapper
+    return decorator
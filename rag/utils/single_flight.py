@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+from langchain_core.embeddings import Embeddings
+
+from rag.utils.deadline import DeadlineExceeded
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """Returns the query in lower case with collapsed whitespaces, used as the coalescing key"""
+    return " ".join(query.lower().split())
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    SingleFlight coalesces identical in-flight calls: concurrent callers with the same key wait for the
+    computation started by the first caller and share its result (or exception), each within its own time budget.
+    Nothing is cached, a call made after the computation completes runs again.
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: Name of the stage, used in the logs
+        """
+        self.name = name
+        self.requests = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+
+    def do(self, key: Hashable, timeout: float, fn: Callable, *args, **kwargs) -> Any:
+        """
+        This method will run fn, or wait for the in-flight call with the same key in another thread.
+        A caller waits at most its own timeout for the in-flight call, and runs fn again if that call only ran out of
+        the other caller's deadline.
+        :param key: Coalescing key
+        :param timeout: Time budget of the caller in seconds
+        :param fn: Function to run
+        :return: Returns the result of fn
+        :raises DeadlineExceeded: if the in-flight call does not complete in time
+        """
+        expires_at = time.monotonic() + timeout
+        with self._lock:
+            self.requests += 1
+        coalesced = False
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                elif not coalesced:
+                    coalesced = True
+                    self.coalesced += 1
+            if leader:
+                break
+
+            logger.info(f"Coalesced {self.name} call: {key}")
+            remaining = expires_at - time.monotonic()
+            if not call.done.wait(None if math.isinf(remaining) else max(remaining, 0)):
+                raise DeadlineExceeded(f"Coalesced {self.name} call did not complete in {timeout:.2f}s")
+            if isinstance(call.error, DeadlineExceeded) and time.monotonic() < expires_at:
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key: Hashable, timeout: float, fn: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        """
+        This method will await fn, or the in-flight task with the same key in the running event loop.
+        A caller waits at most its own timeout for the in-flight task, and runs fn again if that task only ran out
+        of the other caller's deadline.
+        :param key: Coalescing key
+        :param timeout: Time budget of the caller in seconds
+        :param fn: Coroutine function to run
+        :return: Returns the result of fn
+        :raises DeadlineExceeded: if the in-flight task does not complete in time
+        """
+        loop = asyncio.get_running_loop()
+        expires_at = loop.time() + timeout
+        with self._lock:
+            self.requests += 1
+        coalesced = False
+        while True:
+            with self._lock:
+                task = self._tasks.get(key)
+                leader = task is None
+                if leader:
+                    task = self._tasks[key] = asyncio.ensure_future(fn(*args, **kwargs))
+                    task.add_done_callback(lambda _: self._tasks.pop(key, None))
+                elif not coalesced:
+                    coalesced = True
+                    self.coalesced += 1
+            # A cancelled caller must not cancel the computation shared with the other callers
+            if leader:
+                return await asyncio.shield(task)
+
+            logger.info(f"Coalesced {self.name} call: {key}")
+            remaining = expires_at - loop.time()
+            try:
+                return await asyncio.wait_for(asyncio.shield(task),
+                                              timeout=None if math.isinf(remaining) else max(remaining, 0))
+            except DeadlineExceeded:
+                if loop.time() < expires_at:
+                    continue
+                raise
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"Coalesced {self.name} call did not complete in {timeout:.2f}s")
+
+
+class SingleFlightEmbeddings(Embeddings):
+    """Embeddings wrapper coalescing concurrent embeddings of the same query"""
+
+    def __init__(self, embeddings: Embeddings, flight: SingleFlight):
+        self.embeddings = embeddings
+        self.flight = flight
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.flight.do(normalize_query(text), math.inf, self.embeddings.embed_query, text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.flight.do_async(normalize_query(text), math.inf, self.embeddings.aembed_query, text)